@@ -0,0 +1,146 @@
+"""
+Command-line runner for the ICSD queryer.
+
+Only the standard library is imported at module level; `queryer` (and,
+through it, Selenium) and `workqueue` are imported once the arguments have
+been parsed, so that `--help` and argument errors return immediately.
+"""
+import sys
+import json
+import argparse
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+def read_queries(input_file, collection_codes=False):
+    """
+    Read queries from `input_file`, skipping blank lines and lines starting
+    with "#".
+
+    Keyword arguments:
+        input_file:
+            Path to the input file ("-" to read from the standard input).
+            Each line is a JSON object with a query, e.g.,
+            {"composition": "Ni:2:2 Ti:1:1", "number_of_elements": 2}
+
+        collection_codes:
+            Boolean specifying whether the file instead lists ICSD Collection
+            Codes (separated by whitespace and/or commas).
+
+            Default: False.
+
+    Return: (list) A list of query dictionaries
+
+    """
+    if input_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(input_file, 'r') as fr:
+            lines = fr.readlines()
+
+    lines = [l.strip() for l in lines]
+    lines = [l for l in lines if l and not l.startswith('#')]
+    if collection_codes:
+        from icsd_queryer import workqueue
+        codes = [c for l in lines for c in l.replace(',', ' ').split()]
+        return workqueue.collection_code_queries(codes)
+    return [json.loads(l) for l in lines]
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(
+        prog='icsd-queryer',
+        description='Run ICSD queries from a file and save every entry '
+                    '(metadata and CIF) into a folder named after its ICSD '
+                    'Collection Code.')
+    parser.add_argument(
+        'input_file',
+        help='file with one JSON query per line, or with ICSD Collection '
+             'Codes if --codes is specified ("-" for standard input)')
+    parser.add_argument(
+        '--codes', action='store_true',
+        help='the input file lists ICSD Collection Codes')
+    parser.add_argument(
+        '--structure-sources', nargs='+', default=None,
+        choices=['expt', 'mofs', 'theo'],
+        help='structure sources to search (default: expt)')
+    parser.add_argument(
+        '--use-login', action='store_true',
+        help='log in with ICSD_USERID/ICSD_PASSWORD instead of IP-based '
+             'authentication')
+    parser.add_argument(
+        '--log-stream', default=None,
+        help='log file, "console" or "nolog" (default: console)')
+    parser.add_argument(
+        '--output-dir', default=None,
+        help='directory in which the folder for each entry is created '
+             '(default: current directory)')
+    parser.add_argument(
+        '--queue', default=None, metavar='DB_PATH',
+        help='add the queries to the shared work queue DB_PATH and fetch '
+             'chunks from it as one of possibly many workers')
+    parser.add_argument(
+        '--chunk-size', type=int, default=None,
+        help='number of queries per work queue chunk (default: 1)')
+    parser.add_argument(
+        '--lease-duration', type=float, default=None,
+        help='work queue lease duration in seconds (default: 600)')
+    parser.add_argument(
+        '--poll-interval', type=float, default=None,
+        help='keep polling the work queue every POLL_INTERVAL seconds while '
+             'other workers hold leases')
+    return parser
+
+
+def main(argv=None):
+    """
+    Run the queries in the input file, continuing past queries that fail.
+
+    Return: (integer) Exit code -- 0 if all queries succeeded, 1 otherwise
+    """
+    args = _build_parser().parse_args(argv)
+    queries = read_queries(args.input_file, collection_codes=args.codes)
+
+    queryer_kwargs = {
+        'structure_sources': args.structure_sources,
+        'use_login': args.use_login,
+        'log_stream': args.log_stream,
+        'output_dir': args.output_dir,
+    }
+
+    if args.queue:
+        from icsd_queryer import workqueue
+        queue = workqueue.WorkQueue(db_path=args.queue,
+                                    lease_duration=args.lease_duration)
+        chunks = workqueue.chunk_queries(queries, chunk_size=args.chunk_size)
+        queue.add_chunks(chunks)
+        workqueue.run_worker(queue, poll_interval=args.poll_interval,
+                             **queryer_kwargs)
+        # only the chunks of this input file, not the whole shared queue
+        keys = [workqueue.chunk_key(c) for c in chunks]
+        n_failed = queue.counts(keys=keys).get('failed', 0)
+        if n_failed:
+            logger.error('{} chunk(s) in the work queue failed'.format(
+                n_failed))
+            return 1
+        return 0
+
+    from icsd_queryer import queryer
+    n_failed = 0
+    for query in queries:
+        try:
+            q = queryer.Queryer(query=query, **queryer_kwargs)
+            q.perform_icsd_query()
+        except Exception as e:
+            n_failed += 1
+            logger.error('Query {} failed: {!r}'.format(json.dumps(query), e))
+    if n_failed:
+        logger.error('{}/{} queries failed'.format(n_failed, len(queries)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,13 +7,25 @@ from logging import StreamHandler
 from logging import FileHandler
 from logging import NullHandler
 
-from selenium import webdriver
-
-from tags import ICSD_QUERY_TAGS, ICSD_PARSE_TAGS
+from icsd_queryer.tags import ICSD_QUERY_TAGS, ICSD_PARSE_TAGS
 
 
 logger = getLogger(__name__)
 
+# seconds to wait for an exported CIF to appear in the download directory
+CIF_DOWNLOAD_TIMEOUT = 300
+
+
+# the handler installed by `Queryer.add_log_handlers`, and the log stream
+# it writes to
+_log_handler = None
+_log_handler_stream = None
+
+
+def _flush_log_handlers():
+    for handler in logger.handlers:
+        handler.flush()
+
 
 class QueryerError(Exception):
     pass
@@ -33,7 +45,9 @@ class Queryer(object):
                  query=None,
                  save_screenshot=None,
                  structure_sources=None,
-                 log_stream=None):
+                 log_stream=None,
+                 browser_data_dir=None,
+                 output_dir=None):
         """
         Initialize the webdriver and load the URL.
         (Also, check if the "Basic Search" page has loaded successfully.)
@@ -115,12 +129,27 @@ class Queryer(object):
 
                 Default: "console".
 
+            browser_data_dir:
+                Path to the directory used for the browser user profile and
+                downloads. It is deleted and recreated when the driver is
+                started, so concurrent Queryer instances must each use a
+                different directory.
+
+                Default: "browser_data" in the current directory.
+
+            output_dir:
+                Path to the directory in which the folder for each entry is
+                created.
+
+                Default: the current directory.
+
         Attributes:
             url: URL of the search page
             query: query to be posted to the webform
             save_screenshot: whether to take a screenshot of the ICSD page
             structure_sources: which structure sources to search for
             browser_data_dir: directory for browser user profile, related data
+            output_dir: directory into which entries are exported
             driver: instance of Selenium WebDriver running PhantomJS
             hits: number of search hits for the query
 
@@ -150,6 +179,12 @@ class Queryer(object):
         self.log_stream = log_stream
         self.add_log_handlers()
 
+        self._browser_data_dir = None
+        self.browser_data_dir = browser_data_dir
+
+        self._output_dir = None
+        self.output_dir = output_dir
+
         self.driver = self._initialize_driver()
         self.load_web_search()
 
@@ -247,18 +282,56 @@ class Queryer(object):
             log_stream = "console"
         self._log_stream = log_stream
 
+    @property
+    def browser_data_dir(self):
+        return self._browser_data_dir
+
+    @browser_data_dir.setter
+    def browser_data_dir(self, browser_data_dir):
+        if not browser_data_dir:
+            browser_data_dir = os.path.join(os.getcwd(), 'browser_data')
+        self._browser_data_dir = os.path.abspath(browser_data_dir)
+
+    @property
+    def output_dir(self):
+        return self._output_dir
+
+    @output_dir.setter
+    def output_dir(self, output_dir):
+        if not output_dir:
+            output_dir = os.getcwd()
+        self._output_dir = os.path.abspath(output_dir)
+
     def add_log_handlers(self):
-        if self._log_stream.lower() == 'nolog':
-            logger.addHandler(NullHandler)
-        if self._log_stream.lower() == 'console' or self._log_stream is None:
-            std_stream = StreamHandler()
-            logger.addHandler(std_stream)
+        """
+        Attach a handler for `self.log_stream` to the module logger.
+
+        A single handler is installed per process: if an earlier Queryer
+        already installed one for the same log stream, it is reused (so that
+        log lines are not duplicated); otherwise, it is closed and replaced.
+        """
+        global _log_handler, _log_handler_stream
+        if self._log_stream.lower() in ['nolog', 'console']:
+            log_stream = self._log_stream.lower()
+        else:
+            log_stream = os.path.abspath(self._log_stream)
+        if _log_handler in logger.handlers:
+            if _log_handler_stream == log_stream:
+                return
+            logger.removeHandler(_log_handler)
+            _log_handler.close()
+
+        if log_stream == 'nolog':
+            _log_handler = NullHandler()
+        elif log_stream == 'console':
+            _log_handler = StreamHandler()
         else:
-            file_stream = FileHandler(self._log_stream)
-            logger.addHandler(file_stream)
+            _log_handler = FileHandler(log_stream)
+        _log_handler_stream = log_stream
+        logger.addHandler(_log_handler)
 
     def _initialize_driver(self):
-        browser_data_dir = os.path.join(os.getcwd(), 'browser_data')
+        browser_data_dir = self.browser_data_dir
         if os.path.exists(browser_data_dir):
             shutil.rmtree(browser_data_dir, ignore_errors=True)
         self.download_dir = os.path.abspath(os.path.join(browser_data_dir,
@@ -266,6 +339,8 @@ class Queryer(object):
         logger.info('Starting a ChromeDriver ')
         logger.info('with the default download directory:')
         logger.info(' "{}"'.format(self.download_dir))
+        # imported here so that importing this module stays fast
+        from selenium import webdriver
         _options = webdriver.ChromeOptions()
         # using to --no-startup-window to run Chrome in the background throws a
         # WebDriver.Exception with "Message: unknown error: Chrome failed to
@@ -371,7 +446,7 @@ class Queryer(object):
             element_id = ICSD_QUERY_TAGS[k]
             self.driver.find_element_by_id(element_id).send_keys(v)
             logger.info('\t{} = "{}"'.format(k, v))
-        logger.flush()
+        _flush_log_handlers()
 
         self._run_query()
 
@@ -478,7 +553,7 @@ class Queryer(object):
 
         self._check_list_view()
         logger.info('The query yielded {} hits.'.format(self.hits))
-        logger.flush()
+        _flush_log_handlers()
         if self.hits == 0:
             return entries_parsed
 
@@ -491,25 +566,26 @@ class Queryer(object):
             raise QueryerError(error_message)
 
         logger.info('Parsing all the entries...')
-        logger.flush()
+        _flush_log_handlers()
         for i in range(self.hits):
             # get entry data
             entry_data = self.parse_entry()
 
             # create a directory for the entry after the ICSD Collection Code
             coll_code = str(entry_data['collection_code'])
-            if os.path.exists(coll_code):
-                shutil.rmtree(coll_code)
-            os.mkdir(coll_code)
+            entry_dir = os.path.join(self.output_dir, coll_code)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.makedirs(entry_dir)
 
             # write the parsed data into a JSON file in the directory
-            json_file = os.path.join(coll_code, 'metadata.json')
+            json_file = os.path.join(entry_dir, 'metadata.json')
             with open(json_file, 'w') as fw:
                 json.dump(entry_data, fw, indent=2)
 
             # save the screenshot the current page into the directory
             if self.save_screenshot:
-                screenshot_file = os.path.join(coll_code, 'screenshot.png')
+                screenshot_file = os.path.join(entry_dir, 'screenshot.png')
                 self.save_screenshot(fname=screenshot_file)
 
             # get the CIF file
@@ -519,26 +595,30 @@ class Queryer(object):
             # wait for the file download to be completed
             cif_name = 'ICSD_CollCode{}.cif'.format(coll_code)
             cif_source_loc = os.path.join(self.download_dir, cif_name)
-            while True:
+            for _ in range(CIF_DOWNLOAD_TIMEOUT):
                 if os.path.exists(cif_source_loc):
                     break
                 else:
                     time.sleep(1.0)
+            else:
+                self.quit()
+                error_message = 'Timed out waiting for "{}"'.format(cif_name)
+                raise QueryerError(error_message)
             # move it into the directory of the current entry
-            cif_dest_loc = os.path.join(coll_code, '{}.cif'.format(coll_code))
+            cif_dest_loc = os.path.join(entry_dir, '{}.cif'.format(coll_code))
             shutil.move(cif_source_loc, cif_dest_loc)
 
             logger.info('[{}/{}]: '.format(i+1, self.hits))
             logger.info('Data exported into folder:')
-            logger.info('"{}"'.format(coll_code))
-            logger.flush()
+            logger.info('"{}"'.format(entry_dir))
+            _flush_log_handlers()
             entries_parsed.append(coll_code)
 
             if i < (self.hits - 1):
                 self._go_to_next_entry()
 
         logger.info('Closing the browser session and exiting.')
-        logger.flush()
+        _flush_log_handlers()
         self.quit()
         return entries_parsed
 
@@ -657,11 +737,13 @@ class Queryer(object):
     def perform_icsd_query(self):
         """
         Post the query to form, parse data for all the entries. (wrapper)
+
+        Return: (list) A list of ICSD Collection Codes of entries parsed
         """
         try:
             self.select_structure_sources()
             self.post_query_to_form()
-            self.parse_entries()
+            return self.parse_entries()
         finally:
             time.sleep(1.0)
             self.quit()
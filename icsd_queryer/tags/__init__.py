@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import tempfile
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+TAGS_DIR = os.path.abspath(os.path.dirname(__file__))
+query_tags_file = os.path.join(TAGS_DIR, 'query_tags.yml')
+parse_tags_file = os.path.join(TAGS_DIR, 'parse_tags.yml')
+
+
+def _source_hash(yaml_file):
+    with open(yaml_file, 'rb') as fr:
+        return hashlib.sha1(fr.read()).hexdigest()
+
+
+def compile_tags(yaml_file):
+    """
+    Parse the YAML file `yaml_file` and write the tags, along with a hash of
+    the YAML source, into a JSON file next to it ("[name].json"), which is
+    much faster to load than the YAML.
+
+    The JSON file is written to a temporary file and then moved into place,
+    so that concurrent processes never read a partially written table.
+
+    Return: (dict) The tags parsed from `yaml_file`
+    """
+    import yaml
+    with open(yaml_file, 'r') as fr:
+        tags = yaml.safe_load(fr)
+    json_file = os.path.splitext(yaml_file)[0] + '.json'
+    compiled = {'source_sha1': _source_hash(yaml_file), 'tags': tags}
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(json_file),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fw:
+                json.dump(compiled, fw, indent=2)
+                fw.write('\n')
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, json_file)
+        except:
+            os.remove(tmp_file)
+            raise
+    except (IOError, OSError) as e:
+        logger.warning('Failed to write the precompiled tags "{}" ({}); '
+                       'the YAML file will be parsed on every '
+                       'import'.format(json_file, e))
+    return tags
+
+
+def load_tags(yaml_file):
+    """
+    Load the tags in `yaml_file` from the precompiled JSON file, recompiling
+    it if it is missing or does not match the current YAML source.
+
+    Return: (dict) The tags in `yaml_file`
+    """
+    json_file = os.path.splitext(yaml_file)[0] + '.json'
+    try:
+        with open(json_file, 'r') as fr:
+            compiled = json.load(fr)
+        if compiled['source_sha1'] == _source_hash(yaml_file):
+            return compiled['tags']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return compile_tags(yaml_file)
+
+
+ICSD_QUERY_TAGS = load_tags(query_tags_file)
+
+ICSD_PARSE_TAGS = load_tags(parse_tags_file)
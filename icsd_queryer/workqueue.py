@@ -0,0 +1,556 @@
+import os
+import re
+import shutil
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import threading
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class WorkQueueError(Exception):
+    pass
+
+
+class LeaseLostError(WorkQueueError):
+    pass
+
+
+def chunk_queries(queries, chunk_size=None):
+    """
+    Group a list of queries into chunks of (at most) `chunk_size` queries.
+
+    Return: (list) A list of lists of queries
+    """
+    if not chunk_size:
+        chunk_size = 1
+    queries = list(queries)
+    return [queries[i:i+chunk_size] for i in range(0, len(queries),
+                                                   chunk_size)]
+
+
+def collection_code_queries(collection_codes):
+    """
+    Return: (list) One {"icsd_collection_code": code} query per code
+    """
+    return [{'icsd_collection_code': str(c).strip()} for c in collection_codes]
+
+
+def chunk_key(chunk):
+    """
+    Return: (string) Key identifying the chunk of queries `chunk` in the queue
+    """
+    serialized = json.dumps(chunk, sort_keys=True)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+class WorkQueue(object):
+    """
+    Lease-based work queue of ICSD query chunks, stored in an SQLite database
+    that can live on a filesystem shared by several hosts.
+
+    Each chunk is a list of queries (as accepted by `queryer.Queryer`). A
+    worker claims a chunk by taking a lease on it, keeps the lease alive with
+    heartbeats while the chunk is being fetched, and marks it done at the end.
+    Leases that are not renewed expire, and the chunk is handed out again.
+
+    **[Note 1]**: Leases give at-least-once delivery. A chunk whose lease
+    expires, or whose worker fails partway, is fetched again in full by the
+    next worker to claim it (see `fetch_with_queryer` for how entries that
+    were already exported are skipped).
+
+    **[Note 2]**: Lease deadlines are computed from the clock of the host
+    that writes them and compared against the clock of the host claiming a
+    chunk, so the clocks of all hosts must be synchronized (e.g., with NTP),
+    and `lease_duration` should be much larger than any clock skew.
+    """
+
+    def __init__(self,
+                 db_path=None,
+                 lease_duration=None,
+                 max_attempts=None,
+                 worker_id=None):
+        """
+        Create the queue table in the database (if it does not exist).
+
+        Keyword arguments:
+            db_path:
+                Path to the SQLite database file holding the queue. For a
+                multi-host crawl, this should be on a shared filesystem.
+
+                Default: "icsd_queue.sqlite3" in the current directory.
+
+            lease_duration:
+                Number of seconds a claimed chunk stays leased to a worker
+                without a heartbeat.
+
+                Default: 600.
+
+            max_attempts:
+                Number of times a chunk is handed out before it is marked as
+                "failed" and no longer claimed.
+
+                Default: 3.
+
+            worker_id:
+                String identifying the worker holding the leases.
+
+                Default: "[hostname]:[process ID]".
+
+        Attributes:
+            db_path: path to the SQLite database file
+            lease_duration: lease duration in seconds
+            max_attempts: maximum number of claims per chunk
+            worker_id: identifier of this worker
+
+        """
+        self._db_path = None
+        self.db_path = db_path
+
+        self._lease_duration = None
+        self.lease_duration = lease_duration
+
+        self._max_attempts = None
+        self.max_attempts = max_attempts
+
+        self._worker_id = None
+        self.worker_id = worker_id
+
+        self._create_table()
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    @db_path.setter
+    def db_path(self, db_path):
+        if not db_path:
+            db_path = 'icsd_queue.sqlite3'
+        self._db_path = os.path.abspath(db_path)
+
+    @property
+    def lease_duration(self):
+        return self._lease_duration
+
+    @lease_duration.setter
+    def lease_duration(self, lease_duration):
+        if lease_duration is None:
+            lease_duration = 600.
+        self._lease_duration = float(lease_duration)
+
+    @property
+    def max_attempts(self):
+        return self._max_attempts
+
+    @max_attempts.setter
+    def max_attempts(self, max_attempts):
+        if max_attempts is None:
+            max_attempts = 3
+        self._max_attempts = int(max_attempts)
+
+    @property
+    def worker_id(self):
+        return self._worker_id
+
+    @worker_id.setter
+    def worker_id(self, worker_id):
+        if not worker_id:
+            worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._worker_id = worker_id
+
+    def _connect(self):
+        """
+        Open a new connection to the database; connections are not shared
+        between threads or processes.
+
+        The default rollback journal is used instead of WAL, since the latter
+        does not work on network filesystems.
+        """
+        connection = sqlite3.connect(self.db_path, timeout=60.,
+                                     isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _transaction(self, statements):
+        """
+        Run `statements(cursor)` inside a "BEGIN IMMEDIATE" transaction, so
+        that the database is write-locked for the whole read-modify-write.
+
+        Return: whatever `statements` returns
+        """
+        connection = self._connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(cursor)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+        finally:
+            connection.close()
+
+    def _create_table(self):
+        def statements(cursor):
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    key TEXT PRIMARY KEY,
+                    queries TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    owner TEXT,
+                    token TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )""")
+        self._transaction(statements)
+
+    def add_chunks(self, chunks):
+        """
+        Add chunks of queries to the queue. Chunks already in the queue
+        (identical list of queries) are skipped, so that several hosts can
+        populate the queue from the same input.
+
+        Return: (integer) Number of chunks newly added
+        """
+        def statements(cursor):
+            n_added = 0
+            for chunk in chunks:
+                cursor.execute(
+                    'INSERT OR IGNORE INTO chunks (key, queries) '
+                    'VALUES (?, ?)', (chunk_key(chunk), json.dumps(chunk)))
+                n_added += cursor.rowcount
+            return n_added
+        return self._transaction(statements)
+
+    def add_queries(self, queries, chunk_size=None):
+        """
+        Split `queries` into chunks of `chunk_size` and add them to the queue.
+
+        Return: (integer) Number of chunks newly added
+        """
+        return self.add_chunks(chunk_queries(queries, chunk_size=chunk_size))
+
+    def claim(self):
+        """
+        Lease the next available chunk: a pending chunk, or a leased chunk
+        whose lease has expired. Expired chunks that have used up
+        `self.max_attempts` are marked "failed" instead.
+
+        Return: (dict) "key", "token" and "queries" of the leased chunk, or
+        None if there is nothing left to claim
+        """
+        def statements(cursor):
+            now = time.time()
+            cursor.execute(
+                "UPDATE chunks SET status = 'failed', owner = NULL, "
+                "token = NULL, lease_expires = NULL, "
+                "error = COALESCE(error, 'Lease expired') "
+                "WHERE status = 'leased' AND lease_expires < ? "
+                "AND attempts >= ?", (now, self.max_attempts))
+            cursor.execute(
+                "SELECT key, queries FROM chunks WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY rowid LIMIT 1", (now,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            token = uuid.uuid4().hex
+            cursor.execute(
+                "UPDATE chunks SET status = 'leased', owner = ?, token = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE key = ?",
+                (self.worker_id, token, now + self.lease_duration,
+                 row['key']))
+            return {'key': row['key'],
+                    'token': token,
+                    'queries': json.loads(row['queries'])}
+        return self._transaction(statements)
+
+    def _update_lease(self, lease, assignments, values):
+        """
+        Update the leased chunk, provided that `lease` is still the current
+        lease on it; raise LeaseLostError otherwise.
+        """
+        def statements(cursor):
+            cursor.execute(
+                "UPDATE chunks SET {} WHERE key = ? AND token = ? "
+                "AND status = 'leased'".format(assignments),
+                tuple(values) + (lease['key'], lease['token']))
+            if cursor.rowcount != 1:
+                error_message = 'Lease on chunk {} is no longer held'.format(
+                    lease['key'])
+                raise LeaseLostError(error_message)
+        self._transaction(statements)
+
+    def heartbeat(self, lease):
+        """
+        Extend the lease on a claimed chunk by `self.lease_duration`.
+        """
+        self._update_lease(lease, 'lease_expires = ?',
+                           [time.time() + self.lease_duration])
+
+    def complete(self, lease, result=None):
+        """
+        Mark a claimed chunk as done, and store `result` (JSON-serializable)
+        alongside it.
+        """
+        self._update_lease(
+            lease,
+            "status = 'done', token = NULL, lease_expires = NULL, "
+            "result = ?, error = NULL",
+            [json.dumps(result)])
+
+    def release(self, lease, error=None):
+        """
+        Give up the lease on a claimed chunk after a failure. The chunk is
+        returned to the queue, or marked "failed" if it has been claimed
+        `self.max_attempts` times already.
+        """
+        self._update_lease(
+            lease,
+            "status = CASE WHEN attempts >= ? THEN 'failed' "
+            "ELSE 'pending' END, owner = NULL, token = NULL, "
+            "lease_expires = NULL, error = ?",
+            [self.max_attempts, error])
+
+    def counts(self, keys=None):
+        """
+        Keyword arguments:
+            keys:
+                List of chunk keys (see `chunk_key`) to count, e.g., the
+                chunks added from one input file.
+
+                Default: None (all the chunks in the queue).
+
+        Return: (dict) Number of chunks with each status
+        """
+        connection = self._connect()
+        try:
+            if keys is None:
+                rows = connection.execute(
+                    'SELECT status, COUNT(*) AS n FROM chunks '
+                    'GROUP BY status')
+                return {row['status']: row['n'] for row in rows}
+            keys = set(keys)
+            counts = {}
+            rows = connection.execute('SELECT key, status FROM chunks')
+            for row in rows:
+                if row['key'] in keys:
+                    counts[row['status']] = counts.get(row['status'], 0) + 1
+            return counts
+        finally:
+            connection.close()
+
+    def results(self):
+        """
+        Return: (dict) chunk key: result, for all chunks that are done
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT key, result FROM chunks WHERE status = 'done'")
+            return {row['key']: json.loads(row['result']) for row in rows}
+        finally:
+            connection.close()
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Background thread renewing a lease every `interval` seconds until it is
+    stopped, or until the lease is lost.
+
+    Database errors (e.g., "database is locked" on a busy shared filesystem)
+    are retried at the next interval; the lease is only considered lost once
+    its deadline has passed without a successful renewal.
+    """
+
+    def __init__(self, queue, lease, interval):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.lease = lease
+        self.interval = interval
+        self.lost = False
+        self.expires = time.time() + queue.lease_duration
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            renewed_at = time.time()
+            try:
+                self.queue.heartbeat(self.lease)
+            except LeaseLostError:
+                logger.warning('Lost the lease on chunk {}'.format(
+                    self.lease['key']))
+                self.lost = True
+                return
+            except sqlite3.Error as e:
+                logger.warning('Heartbeat for chunk {} failed: {}'.format(
+                    self.lease['key'], e))
+                if time.time() >= self.expires:
+                    logger.warning('Lease on chunk {} expired'.format(
+                        self.lease['key']))
+                    self.lost = True
+                    return
+            else:
+                self.expires = renewed_at + self.queue.lease_duration
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def worker_browser_data_dir(worker_id, base_dir=None):
+    """
+    Return: (string) Path to the browser data directory of the worker
+    `worker_id`, as a subdirectory of `base_dir` (default:
+    "browser_data_workers" in the current directory -- kept apart from
+    "browser_data", which a plain `queryer.Queryer` deletes when it starts)
+    """
+    if not base_dir:
+        base_dir = os.path.join(os.getcwd(), 'browser_data_workers')
+    safe_worker_id = re.sub(r'[^A-Za-z0-9_.-]', '_', worker_id)
+    return os.path.abspath(os.path.join(base_dir, safe_worker_id))
+
+
+def fetch_with_queryer(query, **queryer_kwargs):
+    """
+    Run a single query with `queryer.Queryer`.
+
+    A query for a single ICSD Collection Code is skipped if the CIF of that
+    entry has already been exported into `output_dir`, so that refetching a
+    chunk does not redo (and overwrite) the entries that were completed.
+
+    Return: (list) A list of ICSD Collection Codes of entries parsed
+    """
+    if list(query) == ['icsd_collection_code']:
+        coll_code = str(query['icsd_collection_code'])
+        output_dir = queryer_kwargs.get('output_dir') or os.getcwd()
+        cif_file = os.path.join(output_dir, coll_code,
+                                '{}.cif'.format(coll_code))
+        if os.path.exists(cif_file):
+            logger.info('Skipping {} (already exported)'.format(coll_code))
+            return [coll_code]
+
+    from icsd_queryer import queryer
+    q = queryer.Queryer(query=query, **queryer_kwargs)
+    return q.perform_icsd_query()
+
+
+def run_worker(queue, fetch=None, max_chunks=None, poll_interval=None,
+               **queryer_kwargs):
+    """
+    Claim chunks from `queue` and fetch every query in them, until the queue
+    has nothing left to claim. The lease on a chunk is renewed in the
+    background while it is being fetched.
+
+    Keyword arguments:
+        queue:
+            The `WorkQueue` to take chunks from.
+
+        fetch:
+            Function called as `fetch(query, **queryer_kwargs)` for every
+            query in a chunk; its (JSON-serializable) return values are stored
+            as the result of the chunk.
+
+            Default: `fetch_with_queryer`.
+
+        max_chunks:
+            Stop after processing these many chunks.
+
+            Default: None (no limit).
+
+        poll_interval:
+            If specified, keep polling the queue every `poll_interval`
+            seconds while other workers still hold leases (which may expire
+            and have to be picked up), instead of stopping as soon as nothing
+            can be claimed.
+
+            Default: None.
+
+        queryer_kwargs:
+            Passed on to `fetch` (e.g., `structure_sources`, `use_login`,
+            `output_dir`). Unless specified, `browser_data_dir` is set to a
+            directory specific to the worker (`worker_browser_data_dir`), so
+            that several workers can run in the same directory; that
+            directory is removed when the worker returns.
+
+    Return: (list) A list of keys of the chunks completed by this worker
+
+    """
+    if fetch is None:
+        fetch = fetch_with_queryer
+    worker_dir = None
+    if not queryer_kwargs.get('browser_data_dir'):
+        worker_dir = worker_browser_data_dir(queue.worker_id)
+        queryer_kwargs['browser_data_dir'] = worker_dir
+    try:
+        return _process_chunks(queue, fetch, max_chunks, poll_interval,
+                               queryer_kwargs)
+    finally:
+        if worker_dir is not None:
+            shutil.rmtree(worker_dir, ignore_errors=True)
+            # also remove the base directory, unless other workers use it
+            try:
+                os.rmdir(os.path.dirname(worker_dir))
+            except OSError:
+                pass
+
+
+def _process_chunks(queue, fetch, max_chunks, poll_interval, queryer_kwargs):
+    completed = []
+    while max_chunks is None or len(completed) < max_chunks:
+        lease = queue.claim()
+        if lease is None:
+            if poll_interval and queue.counts().get('leased'):
+                time.sleep(poll_interval)
+                continue
+            break
+        logger.info('Worker {} claimed chunk {}'.format(queue.worker_id,
+                                                        lease['key']))
+        heartbeat = _Heartbeat(queue, lease, queue.lease_duration/3.)
+        heartbeat.start()
+        result = []
+        try:
+            for query in lease['queries']:
+                if heartbeat.lost:
+                    break
+                result.append(fetch(query, **queryer_kwargs))
+        except Exception as e:
+            heartbeat.stop()
+            logger.warning('Chunk {} failed: {}'.format(lease['key'], e))
+            try:
+                queue.release(lease, error=repr(e))
+            except (LeaseLostError, sqlite3.Error) as e:
+                # the lease expires and the chunk is claimed again
+                logger.warning('Failed to release chunk {}: {}'.format(
+                    lease['key'], e))
+            continue
+        heartbeat.stop()
+        if heartbeat.lost:
+            logger.warning('Dropping chunk {} after losing its lease'.format(
+                lease['key']))
+            continue
+        try:
+            queue.complete(lease, result=result)
+        except LeaseLostError:
+            logger.warning('Chunk {} was reclaimed by another worker'.format(
+                lease['key']))
+            continue
+        except sqlite3.Error as e:
+            # the lease expires and the chunk is claimed again; its exported
+            # entries are skipped by `fetch_with_queryer`
+            logger.warning('Failed to mark chunk {} as done: {}'.format(
+                lease['key'], e))
+            continue
+        completed.append(lease['key'])
+    return completed
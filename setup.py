@@ -0,0 +1,18 @@
+from setuptools import setup
+
+
+with open('requirements.txt', 'r') as fr:
+    requirements = [line.strip() for line in fr if line.strip()]
+
+setup(
+    name='icsd-queryer',
+    description='Query data from the ICSD using a Selenium WebDriver',
+    url='https://github.com/hegdevinayi/icsd-queryer',
+    license='MIT',
+    packages=['icsd_queryer', 'icsd_queryer.tags'],
+    package_data={'icsd_queryer.tags': ['*.yml', '*.json']},
+    install_requires=requirements,
+    entry_points={
+        'console_scripts': ['icsd-queryer = icsd_queryer.cli:main'],
+    },
+)
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import logging
+import tempfile
+import subprocess
+
+from icsd_queryer import cli
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds to import the runner, and to run it on a file of 100 collection
+# codes with the driver stubbed out (excluding interpreter startup); about
+# 5x the measured baseline (~0.02 s and ~0.06 s), so that regressions such as
+# eagerly importing PyYAML (~0.035 s) are caught. Slow CI machines can raise
+# them with ICSD_QUERYER_IMPORT_BUDGET and ICSD_QUERYER_STARTUP_BUDGET.
+IMPORT_TIME_BUDGET = float(os.environ.get('ICSD_QUERYER_IMPORT_BUDGET', 0.1))
+STARTUP_TIME_BUDGET = float(
+    os.environ.get('ICSD_QUERYER_STARTUP_BUDGET', 0.25))
+
+# run in a fresh interpreter, so that the imports are measured cold
+_STARTUP_SCRIPT = """
+import sys, time, json
+t_start = time.perf_counter()
+from icsd_queryer import cli
+t_import = time.perf_counter()
+from icsd_queryer import queryer
+queryer.Queryer._initialize_driver = lambda self: None
+queryer.Queryer.load_web_search = lambda self: None
+queryer.Queryer.perform_icsd_query = lambda self: []
+exit_code = cli.main([sys.argv[1], '--codes', '--log-stream', 'nolog'])
+t_main = time.perf_counter()
+print(json.dumps({
+    'exit_code': exit_code,
+    'import_seconds': t_import - t_start,
+    'startup_seconds': t_main - t_start,
+    'modules': [m for m in ('selenium', 'yaml') if m in sys.modules],
+}))
+"""
+
+
+def test_startup_is_lazy_and_within_budget(record_property):
+    input_file = _codes_file([str(c) for c in range(1, 101)])
+    output = subprocess.check_output(
+        [sys.executable, '-c', _STARTUP_SCRIPT, input_file], cwd=REPO_DIR)
+    measured = json.loads(output.decode('utf-8'))
+    # tracked in the test report (e.g., `pytest --junitxml`)
+    record_property('import_seconds', measured['import_seconds'])
+    record_property('startup_seconds', measured['startup_seconds'])
+    print('import: {import_seconds:.4f} s, startup: {startup_seconds:.4f} '
+          's'.format(**measured))
+
+    assert measured['exit_code'] == 0
+    assert measured['modules'] == []
+    assert measured['import_seconds'] < IMPORT_TIME_BUDGET, measured
+    assert measured['startup_seconds'] < STARTUP_TIME_BUDGET, measured
+
+
+def test_read_queries():
+    fd, input_file = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as fw:
+        fw.write('# collection codes\n1, 2\n\n3\n')
+    queries = cli.read_queries(input_file, collection_codes=True)
+    assert queries == [{'icsd_collection_code': c} for c in '123']
+
+    with open(input_file, 'w') as fw:
+        fw.write('{"composition": "Ni:1:1", "number_of_elements": 1}\n')
+    queries = cli.read_queries(input_file)
+    assert queries == [{'composition': 'Ni:1:1', 'number_of_elements': 1}]
+
+
+def _stub_driver(monkeypatch, failing_codes=()):
+    from icsd_queryer import queryer
+    fetched = []
+    monkeypatch.setattr(queryer.logger, 'handlers', [])
+
+    def perform_icsd_query(self):
+        code = self.query['icsd_collection_code']
+        fetched.append(code)
+        if code in failing_codes:
+            raise queryer.QueryerError('# Hits != # Entries in Detailed View')
+        return [code]
+
+    monkeypatch.setattr(queryer.Queryer, '_initialize_driver',
+                        lambda self: None)
+    monkeypatch.setattr(queryer.Queryer, 'load_web_search', lambda self: None)
+    monkeypatch.setattr(queryer.Queryer, 'perform_icsd_query',
+                        perform_icsd_query)
+    return fetched
+
+
+def _codes_file(codes):
+    fd, input_file = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as fw:
+        fw.write('\n'.join(codes))
+    return input_file
+
+
+def test_main_continues_past_failed_queries(monkeypatch):
+    from icsd_queryer import queryer
+    fetched = _stub_driver(monkeypatch, failing_codes=['2'])
+    input_file = _codes_file(['1', '2', '3'])
+    assert cli.main([input_file, '--codes', '--log-stream', 'nolog']) == 1
+    assert fetched == ['1', '2', '3']
+    # one handler for the whole run, not one per query
+    assert len(queryer.logger.handlers) == 1
+
+    fetched = _stub_driver(monkeypatch)
+    assert cli.main([input_file, '--codes']) == 0
+    assert fetched == ['1', '2', '3']
+
+
+def test_main_reports_failed_queue_chunks(monkeypatch):
+    _stub_driver(monkeypatch, failing_codes=['2'])
+    input_file = _codes_file(['1', '2'])
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    output_dir = tempfile.mkdtemp()
+    args = [input_file, '--codes', '--queue', db_path,
+            '--output-dir', output_dir]
+    assert cli.main(args) == 1
+
+    # failed chunks of other inputs in the same queue are not reported
+    _stub_driver(monkeypatch)
+    args[0] = _codes_file(['3', '4'])
+    assert cli.main(args) == 0
+
+
+def test_log_stream_of_each_queryer_is_honored(monkeypatch):
+    from icsd_queryer import queryer
+    _stub_driver(monkeypatch)
+    log_dir = tempfile.mkdtemp()
+    log_a = os.path.join(log_dir, 'a.log')
+    log_b = os.path.join(log_dir, 'b.log')
+
+    queryer.Queryer(log_stream=log_a)
+    handler_a = queryer.logger.handlers[0]
+    queryer.Queryer(log_stream=log_a)
+    assert queryer.logger.handlers == [handler_a]
+
+    queryer.Queryer(log_stream=log_b)
+    assert len(queryer.logger.handlers) == 1
+    assert queryer.logger.handlers[0].baseFilename == log_b
+    assert handler_a.stream is None
+
+    queryer.Queryer(log_stream='nolog')
+    assert len(queryer.logger.handlers) == 1
+    assert isinstance(queryer.logger.handlers[0], logging.NullHandler)
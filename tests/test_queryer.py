@@ -1,5 +1,5 @@
 import logging
-import queryer
+from icsd_queryer import queryer
 
 
 logging.root.setLevel(logging.DEBUG)
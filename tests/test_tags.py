@@ -0,0 +1,49 @@
+import os
+import json
+import shutil
+import tempfile
+
+import yaml
+
+from icsd_queryer import tags
+
+
+def _copy_yaml(name):
+    tmp_dir = tempfile.mkdtemp()
+    yaml_file = os.path.join(tmp_dir, name)
+    shutil.copy(os.path.join(tags.TAGS_DIR, name), yaml_file)
+    return yaml_file
+
+
+def test_precompiled_tags_match_yaml():
+    for yaml_file in [tags.query_tags_file, tags.parse_tags_file]:
+        with open(yaml_file, 'r') as fr:
+            expected = yaml.safe_load(fr)
+        json_file = os.path.splitext(yaml_file)[0] + '.json'
+        with open(json_file, 'r') as fr:
+            compiled = json.load(fr)
+        assert compiled['tags'] == expected
+        assert compiled['source_sha1'] == tags._source_hash(yaml_file)
+
+
+def test_stale_tags_are_recompiled():
+    yaml_file = _copy_yaml('query_tags.yml')
+    assert tags.load_tags(yaml_file) == tags.ICSD_QUERY_TAGS
+    with open(yaml_file, 'a') as fw:
+        fw.write('new_field: "content_form:newField"\n')
+    assert tags.load_tags(yaml_file)['new_field'] == 'content_form:newField'
+    json_file = os.path.splitext(yaml_file)[0] + '.json'
+    with open(json_file, 'r') as fr:
+        assert 'new_field' in json.load(fr)['tags']
+    assert sorted(os.listdir(os.path.dirname(yaml_file))) == [
+        'query_tags.json', 'query_tags.yml']
+
+
+def test_unwritable_tags_cache_warns(caplog):
+    yaml_file = _copy_yaml('query_tags.yml')
+    # a directory in place of the JSON file cannot be replaced
+    os.mkdir(os.path.splitext(yaml_file)[0] + '.json')
+    assert tags.load_tags(yaml_file) == tags.ICSD_QUERY_TAGS
+    assert 'Failed to write the precompiled tags' in caplog.text
+    assert not [f for f in os.listdir(os.path.dirname(yaml_file))
+                if f.endswith('.tmp')]
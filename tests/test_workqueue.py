@@ -0,0 +1,193 @@
+import os
+import time
+import sqlite3
+import tempfile
+import multiprocessing
+
+from icsd_queryer import workqueue
+
+
+def _fake_fetch(query, output_dir=None, browser_data_dir=None):
+    # one file per fetch; a second fetch of the same query would fail here
+    code = query['icsd_collection_code']
+    if not os.path.isdir(browser_data_dir):
+        os.makedirs(browser_data_dir)
+    fd = os.open(os.path.join(output_dir, code),
+                 os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    os.close(fd)
+    time.sleep(0.01)
+    return [code, browser_data_dir]
+
+
+def _worker(db_path, output_dir):
+    queue = workqueue.WorkQueue(db_path=db_path, lease_duration=5.)
+    workqueue.run_worker(queue, fetch=_fake_fetch, output_dir=output_dir)
+
+
+def test_each_chunk_fetched_once_across_workers():
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'queue.sqlite3')
+    codes = [str(c) for c in range(1, 201)]
+    queue = workqueue.WorkQueue(db_path=db_path)
+    queries = workqueue.collection_code_queries(codes)
+    assert queue.add_queries(queries, chunk_size=4) == 50
+    # populating the queue again (e.g. from another host) is a no-op
+    assert queue.add_queries(queries, chunk_size=4) == 0
+
+    workers = [multiprocessing.Process(target=_worker,
+                                       args=(db_path, tmp_dir))
+               for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+
+    assert queue.counts() == {'done': 50}
+    fetched = [r for chunk in queue.results().values() for r in chunk]
+    assert sorted(code for code, _ in fetched) == sorted(codes)
+    # every worker has its own browser profile/download directory
+    browser_data_dirs = set(d for _, d in fetched)
+    assert len(browser_data_dirs) > 1
+    for d in browser_data_dirs:
+        # apart from "browser_data", which a plain Queryer deletes on start
+        assert os.path.dirname(d) == os.path.join(os.getcwd(),
+                                                  'browser_data_workers')
+        # removed when the worker returns
+        assert not os.path.exists(d)
+
+
+def test_worker_browser_data_dirs_differ():
+    dirs = set(workqueue.worker_browser_data_dir(w)
+               for w in ['host1:100', 'host1:101', 'host2:100'])
+    assert len(dirs) == 3
+
+
+def test_chunk_dropped_after_lease_lost():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    queue = workqueue.WorkQueue(db_path=db_path, lease_duration=0.3)
+    queue.add_queries([{'icsd_collection_code': str(c)} for c in range(5)],
+                      chunk_size=5)
+    fetched = []
+
+    def slow_fetch(query, **kwargs):
+        fetched.append(query['icsd_collection_code'])
+        # expire the lease (as if heartbeats were stalled) and let another
+        # worker reclaim the chunk, before the next heartbeat
+        connection = sqlite3.connect(db_path)
+        with connection:
+            connection.execute('UPDATE chunks SET lease_expires = 0')
+        connection.close()
+        other = workqueue.WorkQueue(db_path=db_path, worker_id='other')
+        assert other.claim() is not None
+        time.sleep(0.3)
+        return []
+
+    assert workqueue.run_worker(queue, fetch=slow_fetch) == []
+    assert fetched == ['0']
+    assert queue.counts() == {'leased': 1}
+
+
+def test_exported_entries_are_not_refetched():
+    output_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(output_dir, '42'))
+    open(os.path.join(output_dir, '42', '42.cif'), 'w').close()
+    result = workqueue.fetch_with_queryer({'icsd_collection_code': 42},
+                                          output_dir=output_dir)
+    assert result == ['42']
+
+
+def test_expired_lease_is_reclaimed():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    dead = workqueue.WorkQueue(db_path=db_path, lease_duration=0.1,
+                               worker_id='dead')
+    dead.add_queries([{'icsd_collection_code': '1'}])
+    lease = dead.claim()
+    assert dead.claim() is None
+
+    time.sleep(0.2)
+    alive = workqueue.WorkQueue(db_path=db_path, worker_id='alive')
+    new_lease = alive.claim()
+    assert new_lease['key'] == lease['key']
+    assert new_lease['token'] != lease['token']
+
+    # the original holder can no longer complete or renew the chunk
+    for method in (dead.heartbeat, dead.complete):
+        try:
+            method(lease)
+        except workqueue.LeaseLostError:
+            pass
+        else:
+            raise AssertionError('stale lease was accepted')
+    alive.complete(new_lease, result=['1'])
+    assert alive.counts() == {'done': 1}
+
+
+def test_chunk_fails_after_max_attempts():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    queue = workqueue.WorkQueue(db_path=db_path, max_attempts=2)
+    queue.add_queries([{'icsd_collection_code': '1'}])
+    queue.release(queue.claim(), error='timeout')
+    assert queue.counts() == {'pending': 1}
+    queue.release(queue.claim(), error='timeout')
+    assert queue.counts() == {'failed': 1}
+    assert queue.claim() is None
+
+
+def test_heartbeat_survives_database_errors():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    queue = workqueue.WorkQueue(db_path=db_path, lease_duration=0.3)
+    queue.add_queries([{'icsd_collection_code': '1'}])
+    heartbeat = queue.heartbeat
+    n_calls = []
+
+    def flaky_heartbeat(lease):
+        n_calls.append(1)
+        if len(n_calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        heartbeat(lease)
+
+    def slow_fetch(query, **kwargs):
+        time.sleep(0.6)
+        return []
+
+    queue.heartbeat = flaky_heartbeat
+    assert len(workqueue.run_worker(queue, fetch=slow_fetch)) == 1
+    assert len(n_calls) > 1
+    assert queue.counts() == {'done': 1}
+
+
+def test_chunk_dropped_when_heartbeats_keep_failing():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    queue = workqueue.WorkQueue(db_path=db_path, lease_duration=0.3)
+    queue.add_queries([{'icsd_collection_code': str(c)} for c in range(3)],
+                      chunk_size=3)
+    fetched = []
+
+    def failing_heartbeat(lease):
+        raise sqlite3.OperationalError('database is locked')
+
+    def slow_fetch(query, **kwargs):
+        fetched.append(query['icsd_collection_code'])
+        time.sleep(0.25)
+        return []
+
+    queue.heartbeat = failing_heartbeat
+    assert workqueue.run_worker(queue, fetch=slow_fetch) == []
+    # the lease expires during the second query on every claim, so the third
+    # is never fetched, until the chunk has used up its attempts
+    assert fetched == ['0', '1'] * queue.max_attempts
+    assert queue.counts() == {'failed': 1}
+
+
+def test_worker_survives_database_errors_on_complete():
+    db_path = os.path.join(tempfile.mkdtemp(), 'queue.sqlite3')
+    queue = workqueue.WorkQueue(db_path=db_path)
+    queue.add_queries([{'icsd_collection_code': '1'}])
+
+    def failing_complete(lease, result=None):
+        raise sqlite3.OperationalError('database is locked')
+
+    queue.complete = failing_complete
+    assert workqueue.run_worker(queue, fetch=lambda query, **kwargs: []) == []
+    assert queue.counts() == {'leased': 1}